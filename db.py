@@ -1,8 +1,132 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 import pandas as pd
 import glob
+import csv
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import matplotlib.pyplot as plt
 
+# pyarrow is optional, its multithreaded reader is used to parse csv files when it is installed
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+# default limit on bound parameters per statement for sqlite builds before 3.32, which caps multi-row inserts
+SQLITE_MAX_VARIABLES = 999
+INSERT_CHUNKSIZE = 10000
+
+# sheets with title rows above the column headers
+HEADER_ROW_SHEETS = ('rate_birth_2015', 'life_expectancy_2015')
+
+# workbook sheets to be loaded, any others are ignored
+AVAILABLE_SHEETS = frozenset(
+    ['default_constants', 'country_constants', 'default_programs', 'country_programs', 'bcg_2014', 'bcg_2015',
+     'bcg_2016', 'rate_birth_2014', 'rate_birth_2015', 'life_expectancy_2014', 'life_expectancy_2015',
+     'notifications_2014', 'notifications_2015', 'notifications_2016', 'outcomes_2013', 'outcomes_2015',
+     'mdr_2014', 'mdr_2015', 'mdr_2016', 'laboratories_2014', 'laboratories_2015', 'laboratories_2016',
+     'strategy_2014', 'strategy_2015', 'strategy_2016', 'diabetes', 'gtb_2015', 'gtb_2016', 'latent_2016',
+     'tb_hiv_2016', 'spending_inputs'])
+
+
+# pragmas trading durability for speed while ingesting, as the db can always be rebuilt from the inputs, none of which
+# persist in the db file, and the sqlite defaults they are reset to afterwards
+INGEST_PRAGMAS = ('journal_mode=MEMORY', 'synchronous=OFF', 'temp_store=MEMORY', 'cache_size=-200000')
+DEFAULT_PRAGMAS = ('journal_mode=DELETE', 'synchronous=FULL', 'temp_store=DEFAULT', 'cache_size=-2000')
+
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+    """
+        Set pragmas on a raw sqlite connection, outside of any transaction as some can't be changed within one
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+        cursor.execute('PRAGMA ' + pragma)
+    cursor.close()
+
+
+def quote_identifier(name):
+    """
+        Quote a table or column name for use in raw sqlite statements
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def unquote_identifier(name):
+    """
+        Remove the double quotes from a table or column name that has been quoted as for sqlite
+    """
+    if len(name) > 1 and name.startswith('"') and name.endswith('"'):
+        return name[1: -1].replace('""', '"')
+    return name
+
+
+def source_key(filename):
+    """
+        Fingerprint a source file by its path, modification time and size
+    """
+    status = os.stat(filename)
+    return hashlib.sha1(str((os.path.abspath(filename), status.st_mtime_ns, status.st_size)).encode()).hexdigest()
+
+
+def is_ingested(dbapi_connection, filename):
+    """
+        Check the ingest manifest for whether filename has already been loaded in its current state
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('CREATE TABLE IF NOT EXISTS ingest_manifest (source TEXT PRIMARY KEY, source_key TEXT)')
+    cursor.execute('SELECT source_key FROM ingest_manifest WHERE source = ?', (os.path.abspath(filename),))
+    row = cursor.fetchone()
+    cursor.close()
+    return row is not None and row[0] == source_key(filename)
+
+
+def record_ingest(dbapi_connection, filename):
+    """
+        Record the current state of filename in the ingest manifest once its tables have been written
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('INSERT OR REPLACE INTO ingest_manifest VALUES (?, ?)',
+                   (os.path.abspath(filename), source_key(filename)))
+    cursor.close()
+
+
+def read_csv_rows(filename):
+    """
+        Iterate over the header and then the rows of a csv file with empty fields as None, parsing with pyarrow's
+        multithreaded reader if it is available and otherwise with the csv module
+    """
+    with open(filename, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        yield header
+        if pyarrow is None:
+            for row in reader:
+                yield [value if value != '' else None for value in row]
+            return
+
+    # keep all fields as text so that typing is left to sqlite as for the csv module
+    convert_options = pyarrow.csv.ConvertOptions(
+        column_types={column: pyarrow.string() for column in header}, null_values=[''], strings_can_be_null=True)
+    table = pyarrow.csv.read_csv(filename, convert_options=convert_options)
+    yield from zip(*(column.to_numpy().tolist() for column in table.columns))
+
+
+def read_workbook(filename):
+    """
+        Open a workbook once and read all its wanted sheets, kept at module level so it can be sent to worker processes
+    """
+    with pd.ExcelFile(filename) as xls:
+        sheet_names = xls.sheet_names
+        wanted = [sheet for sheet in sheet_names if sheet in AVAILABLE_SHEETS] if len(sheet_names) > 1 else []
+        header_sheets = [sheet for sheet in wanted if sheet in HEADER_ROW_SHEETS]
+        frames = pd.read_excel(xls, sheet_name=[sheet for sheet in wanted if sheet not in header_sheets])
+        frames.update(pd.read_excel(xls, sheet_name=header_sheets, header=3))
+    return sheet_names, {sheet: frames[sheet] for sheet in wanted}
+
 
 class InputDB:
     """
@@ -15,63 +139,130 @@ class InputDB:
         """
         self.dbname = dbname
         self.engine = create_engine('sqlite:///' + dbname , echo=True)
+        self.query_cache = {}
+
+    @contextmanager
+    def begin_ingest(self):
+        """
+            Open a transaction for loading inputs on a connection set up for fast ingest, restoring the default
+            pragmas before the connection is returned to the pool to be used for queries
+        """
+        with self.engine.connect() as connection:
+            set_sqlite_pragmas(connection.connection, INGEST_PRAGMAS)
+            try:
+                with connection.begin():
+                    yield connection
+            finally:
+                set_sqlite_pragmas(connection.connection, DEFAULT_PRAGMAS)
 
-    def load_csv(self, inputPath='xls/*.csv'):
+    def write_table(self, df, table_name, connection):
         """
-            Load CSVs from inputPath
+            Write dataframe to table_name as batched multi-row inserts within the caller's transaction, declaring the
+            table up front so that to_sql only appends rather than reflecting and replacing the existing table
         """
+        connection.execute(text('DROP TABLE IF EXISTS ' + quote_identifier(table_name)))
+        connection.execute(text(pd.io.sql.get_schema(df, table_name, con=connection)))
+        chunksize = max(1, min(INSERT_CHUNKSIZE, SQLITE_MAX_VARIABLES // max(len(df.columns), 1)))
+        df.to_sql(table_name, con=connection, if_exists='append', index=False, method='multi', chunksize=chunksize)
+
+    def load_all(self, csvPath='xls/*.csv', xlsxPath='xls/*.xlsx'):
+        """
+            Load both CSVs and xslx files through one connection, committing all their tables together
+        """
+        with self.begin_ingest() as connection:
+            self.load_csv(csvPath, connection)
+            self.load_xslx(xlsxPath, connection)
+
+    def load_csv(self, inputPath='xls/*.csv', connection=None):
+        """
+            Load CSVs from inputPath, streaming rows into sqlite without dataframes and skipping unchanged files
+        """
+        if connection is None:
+            with self.begin_ingest() as connection:
+                return self.load_csv(inputPath, connection)
         csvfileList = glob.glob(inputPath)
+        self.query_cache.clear()
+
+        # the raw sqlite connection under the transaction, as executemany bypasses sqlalchemy's statement handling
+        dbapi_connection = connection.connection
+        for filename in [name for name in csvfileList if not is_ingested(dbapi_connection, name)]:
+            dfname = os.path.splitext(os.path.basename(filename))[0]
+            rows = read_csv_rows(filename)
+            header = next(rows)
 
-        for filename in csvfileList:
-            dfname = filename.split('\\')[1].split('.')[0]
-            df = pd.read_csv(filename)
-            df.to_sql(dfname, con=self.engine, if_exists='replace')
+            # numeric affinity stores numeric-looking text as integers or reals, as read_csv would have typed it
+            table_name = quote_identifier(dfname)
+            cursor = dbapi_connection.cursor()
+            cursor.execute('DROP TABLE IF EXISTS ' + table_name)
+            cursor.execute('CREATE TABLE %s (%s)'
+                           % (table_name, ', '.join(quote_identifier(col) + ' NUMERIC' for col in header)))
+            cursor.executemany('INSERT INTO %s VALUES (%s)' % (table_name, ', '.join('?' * len(header))), rows)
+            cursor.close()
+            record_ingest(dbapi_connection, filename)
 
-    def load_xslx(self, inputPath = 'xls/*.xlsx'):
+    def load_xslx(self, inputPath = 'xls/*.xlsx', connection=None):
         """
-            Load xslx from inputPath
+            Load xslx from inputPath, skipping workbooks unchanged since they were last loaded
         """
+        if connection is None:
+            with self.begin_ingest() as connection:
+                return self.load_xslx(inputPath, connection)
         excelFileList = glob.glob(inputPath)
-        available_sheets \
-            = ['default_constants', 'country_constants', 'default_programs', 'country_programs', 'bcg_2014', 'bcg_2015',
-               'bcg_2016', 'rate_birth_2014', 'rate_birth_2015', 'life_expectancy_2014', 'life_expectancy_2015',
-               'notifications_2014', 'notifications_2015', 'notifications_2016', 'outcomes_2013', 'outcomes_2015',
-               'mdr_2014', 'mdr_2015', 'mdr_2016', 'laboratories_2014', 'laboratories_2015', 'laboratories_2016',
-               'strategy_2014', 'strategy_2015', 'strategy_2016', 'diabetes', 'gtb_2015', 'gtb_2016', 'latent_2016',
-               'tb_hiv_2016', 'spending_inputs']
-
-        for filename in excelFileList:
-            xls = pd.ExcelFile(filename)
-
-            if len(xls.sheet_names) == 1:
-                df_name = xls.sheet_names[0]
-                print(df_name)
+        self.query_cache.clear()
+        changed_files = [name for name in excelFileList if not is_ingested(connection.connection, name)]
+        if not changed_files:
+            return
+
+        # parse workbooks in parallel as parsing dominates over the single-writer inserts
+        with ProcessPoolExecutor() as executor:
+            for filename, (sheet_names, frames) in zip(changed_files, executor.map(read_workbook, changed_files)):
+                if len(sheet_names) == 1:
+                    print(sheet_names[0])
+                for sheet_name, df in frames.items():
+                    print(sheet_name)
+                    self.write_table(df, sheet_name, connection)
+                record_ingest(connection.connection, filename)
+
+    def compile_query(self, table_name, filter, column):
+        """
+            build the select statement for a query, checking the identifiers against the schema as they cannot be bound
+            column is '*', a list or tuple of column names, or a comma-separated string of names which may be wrapped
+            in double quotes, as they would be written in sql, so that names containing spaces or commas can be given
+        """
+        if not isinstance(column, str):
+            column = tuple(column)
+        filter = unquote_identifier(filter)
+        if (table_name, filter, column) not in self.query_cache:
+            inspector = inspect(self.engine)
+            if table_name not in inspector.get_table_names():
+                raise ValueError("table %s not found in database" % table_name)
+            available_columns = [col['name'] for col in inspector.get_columns(table_name)]
+            if column == '*':
+                requested_columns = []
+            elif isinstance(column, tuple):
+                requested_columns = list(column)
             else:
-                numSheets = 0
-                while numSheets < len(xls.sheet_names):
-                      sheet_name = xls.sheet_names[numSheets]
-                      if sheet_name in available_sheets:
-                          if sheet_name == 'rate_birth_2015' or sheet_name == 'life_expectancy_2015' :
-                              df = pd.read_excel(filename, sheet_name=sheet_name, header = 3)
-                          else:
-                              df = pd.read_excel(filename, sheet_name=sheet_name)
-                          print(sheet_name)
-                          df.to_sql(sheet_name, con=self.engine, if_exists='replace')
-                      numSheets = numSheets + 1
+                requested_columns = [col.strip() for col in next(csv.reader([column], skipinitialspace=True))]
+            for requested in requested_columns + ([filter] if filter != '' else []):
+                if requested not in available_columns:
+                    raise ValueError("column %s not found in table %s" % (requested, table_name))
+
+            query = "SELECT %s FROM %s" % (
+                column if column == '*' else ', '.join(quote_identifier(col) for col in requested_columns),
+                quote_identifier(table_name))
+            if filter != '':
+                query += " WHERE %s = :value" % quote_identifier(filter)
+            self.query_cache[(table_name, filter, column)] = text(query)
+        return self.query_cache[(table_name, filter, column)]
 
     def dbQuery(self, table_name, filter="", value="", column='*'):
         """
             method to query tablename
         """
-
-        if ' ' in filter:
-            filter = '\"' + filter + '\"'
-
-        query ="Select "  + column + " from  " + table_name
         if filter != '' and value != '':
-            query = "Select  " + column + "  from  " + table_name + " Where  " + filter + "  =  \'" + value + '\''
-        output_from_db = pd.read_sql_query(query, con=self.engine)
-        return output_from_db
+            query = self.compile_query(table_name, filter, column)
+            return pd.read_sql_query(query, con=self.engine, params={'value': value})
+        return pd.read_sql_query(self.compile_query(table_name, '', column), con=self.engine)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,29 @@
 import numpy
-from scipy.integrate import odeint, solve_ivp
-import matplotlib.pyplot
-import copy
+from scipy.integrate import odeint, solve_ivp, ode
+from scipy.sparse import csr_matrix
+import math
 import pandas
 from graphviz import Digraph
 from sqlalchemy import create_engine
 import os
+import hashlib
+import sys
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+# numba is optional, the numerical kernels are written so that they also run as plain numpy code
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# numbalsoda is optional, allowing integration with compiled odes that never call back into python
+try:
+    from numba import carray, cfunc
+    from numbalsoda import lsoda, lsoda_sig
+except ImportError:
+    lsoda = None
 
 # set path - sachin
 os.environ["PATH"] += os.pathsep + 'C:/Users/swas0001/graphviz-2.38/release/bin'
@@ -14,9 +32,220 @@ os.environ["PATH"] += os.pathsep + 'C:/Users/swas0001/graphviz-2.38/release/bin'
 os.environ["PATH"] += os.pathsep + 'C:/Program Files (x86)/Graphviz2.38/bin'
 
 
+# flow types that are applied as transitions, in the order of the integer codes used during integration
+TRANSITION_FLOW_TYPES = ("standard_flows", "infection_density", "infection_frequency")
+
+# points to tabulate time-variant functions at for numbalsoda or runge-kutta integration when no grid has been
+# requested, as the compiled odes can only interpolate them
+COMPILED_TIME_VARIANT_GRID_POINTS = 1001
+
+# runge-kutta steps taken between each pair of output times
+RK4_SUBSTEPS = 10
+
+
+def jit(function):
+    """
+    compile a numerical kernel with numba if it is installed, otherwise return the numpy implementation unchanged
+    """
+    return function if njit is None else njit(cache=True, fastmath=True)(function)
+
+
+@jit
+def apply_flow_arrays(ode_equations, compartment_values, transition_origins, transition_destinations, flow_rates,
+                      death_origins, death_rates, universal_death_rate):
+    """
+    apply the transition flows, compartment-specific deaths and universal deaths to the odes together from arrays of
+    compartment indices and per capita rates, returning the total deaths
+    """
+    transition_flows = flow_rates * compartment_values[transition_origins]
+    death_flows = death_rates * compartment_values[death_origins]
+    ode_equations += numpy.bincount(transition_destinations, transition_flows, len(ode_equations)) - \
+        numpy.bincount(transition_origins, transition_flows, len(ode_equations)) - \
+        numpy.bincount(death_origins, death_flows, len(ode_equations)) - universal_death_rate * compartment_values
+    return death_flows.sum() + universal_death_rate * compartment_values.sum()
+
+
+@jit
+def find_flow_derivatives(time, compartment_values, ode_equations, grid_times, grid_values, parameter_constants,
+                          component_parameters, component_time_variants, transition_origins, transition_destinations,
+                          transition_parameter_indices, transition_type_codes, death_origins, death_parameter_indices,
+                          universal_death_rate_index, infectious_weights, entry_fractions, birth_code,
+                          crude_birth_rate):
+    """
+    evaluate the whole of the odes from arrays, with parameters found as their constant values multiplied by their
+    time-variant components interpolated from a grid
+    """
+    parameter_values = parameter_constants.copy()
+    for n_component in range(len(component_parameters)):
+        parameter_values[component_parameters[n_component]] *= \
+            numpy.interp(time, grid_times, grid_values[component_time_variants[n_component]])
+    find_odes(ode_equations, compartment_values, parameter_values, transition_origins, transition_destinations,
+              transition_parameter_indices, transition_type_codes, death_origins, death_parameter_indices,
+              universal_death_rate_index, infectious_weights, entry_fractions, birth_code, crude_birth_rate)
+
+
+@jit
+def find_odes(ode_equations, compartment_values, parameter_values, transition_origins, transition_destinations,
+              transition_parameter_indices, transition_type_codes, death_origins, death_parameter_indices,
+              universal_death_rate_index, infectious_weights, entry_fractions, birth_code, crude_birth_rate):
+    """
+    evaluate the whole of the odes into ode_equations from arrays and the flow parameter values at the time being
+    evaluated, with births coded as 0 for none, 1 for a crude birth rate and 2 to replace deaths
+    """
+
+    # infectious multipliers indexed by the transition flow type codes
+    infectious_population = (infectious_weights * compartment_values).sum()
+    infectious_multipliers = \
+        numpy.array([1.0, infectious_population, infectious_population / compartment_values.sum()])
+
+    ode_equations[:] = 0.0
+    total_deaths = apply_flow_arrays(
+        ode_equations, compartment_values, transition_origins, transition_destinations,
+        parameter_values[transition_parameter_indices] * infectious_multipliers[transition_type_codes], death_origins,
+        parameter_values[death_parameter_indices], parameter_values[universal_death_rate_index])
+    if birth_code == 1:
+        ode_equations += crude_birth_rate * compartment_values.sum() * entry_fractions
+    elif birth_code == 2:
+        ode_equations += total_deaths * entry_fractions
+
+
+def pack_model_arrays(arrays):
+    """
+    pack a sequence of arrays into one float array headed by the number of arrays and their lengths, so that they can
+    all be passed to compiled odes through a single data pointer
+    """
+    return numpy.concatenate(
+        [[len(arrays)], [len(array) for array in arrays]] + [numpy.asarray(array, dtype=float) for array in arrays])
+
+
+@jit
+def unpack_model_array(packed_arrays, n_array):
+    """
+    find one of the arrays packed together by pack_model_arrays
+    """
+    start = 1 + int(packed_arrays[0])
+    for n_previous in range(n_array):
+        start += int(packed_arrays[1 + n_previous])
+    return packed_arrays[start: start + int(packed_arrays[1 + n_array])]
+
+
+@jit
+def find_packed_flow_derivatives(time, compartment_values, ode_equations, packed_arrays):
+    """
+    evaluate the odes from the model arrays packed in the order of the arguments to find_flow_derivatives, with the
+    entry fractions first so that their length gives the number of compartments, and a final array of the scalars
+    """
+    grid_times = unpack_model_array(packed_arrays, 2)
+    scalars = unpack_model_array(packed_arrays, 13)
+    find_flow_derivatives(
+        time, compartment_values, ode_equations, grid_times,
+        unpack_model_array(packed_arrays, 3).reshape((-1, len(grid_times))), unpack_model_array(packed_arrays, 4),
+        unpack_model_array(packed_arrays, 5).astype(numpy.int64),
+        unpack_model_array(packed_arrays, 6).astype(numpy.int64),
+        unpack_model_array(packed_arrays, 7).astype(numpy.int64),
+        unpack_model_array(packed_arrays, 8).astype(numpy.int64),
+        unpack_model_array(packed_arrays, 9).astype(numpy.int64),
+        unpack_model_array(packed_arrays, 10).astype(numpy.int64),
+        unpack_model_array(packed_arrays, 11).astype(numpy.int64),
+        unpack_model_array(packed_arrays, 12).astype(numpy.int64), int(scalars[0]),
+        unpack_model_array(packed_arrays, 1), unpack_model_array(packed_arrays, 0), int(scalars[1]), scalars[2])
+
+
+@jit
+def integrate_packed_rk4(initial_values, times, packed_arrays, substeps):
+    """
+    integrate the odes from the packed model arrays with a fixed-step fourth order runge-kutta scheme taking substeps
+    steps between output times, so that with numba the whole integration runs without returning to python
+    """
+    outputs = numpy.zeros((len(times), len(initial_values)))
+    outputs[0] = initial_values
+    compartment_values = initial_values.copy()
+    k1, k2, k3, k4 = [numpy.zeros(len(initial_values)) for _ in range(4)]
+    for n_time in range(1, len(times)):
+        time, step = times[n_time - 1], (times[n_time] - times[n_time - 1]) / substeps
+        for _ in range(substeps):
+            find_packed_flow_derivatives(time, compartment_values, k1, packed_arrays)
+            find_packed_flow_derivatives(time + step / 2.0, compartment_values + step / 2.0 * k1, k2, packed_arrays)
+            find_packed_flow_derivatives(time + step / 2.0, compartment_values + step / 2.0 * k2, k3, packed_arrays)
+            find_packed_flow_derivatives(time + step, compartment_values + step * k3, k4, packed_arrays)
+            compartment_values += step / 6.0 * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+            time += step
+        outputs[n_time] = compartment_values
+    return outputs
+
+
+# odes for numbalsoda, compiled when first needed and then shared by all models
+COMPILED_ODES = {}
+
+
+def compile_packed_odes():
+    """
+    compile the odes for numbalsoda once, with the model arrays passed through the data pointer so that lsoda calls
+    them directly without going through python and without recompiling for each model
+    """
+    if "packed" not in COMPILED_ODES:
+        @cfunc(lsoda_sig, cache=True)
+        def compiled_flow_derivatives(time, compartment_values, ode_equations, data):
+            n_arrays = int(carray(data, (1,))[0])
+            array_lengths = carray(data, (1 + n_arrays,))[1:]
+            n_compartments = int(array_lengths[0])
+            find_packed_flow_derivatives(
+                time, carray(compartment_values, (n_compartments,)), carray(ode_equations, (n_compartments,)),
+                carray(data, (1 + n_arrays + int(array_lengths.sum()),)))
+        COMPILED_ODES["packed"] = compiled_flow_derivatives
+    return COMPILED_ODES["packed"]
+
+
+# odes generated for each model structure, keyed by their source code so that models with the same flows share them
+GENERATED_ODES = {}
+
+# directory that the generated odes are written to as modules, so that numba can cache their compiled versions on disk
+GENERATED_ODES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+
+
+def load_generated_odes_module(source):
+    """
+    write the source code of a generated odes function to a module named by its hash and import the function from it,
+    with the module written to a temporary file first so that processes building the same model don't read it half
+    written
+    """
+    module_name = "generated_odes_" + hashlib.sha1(source.encode()).hexdigest()
+    module_path = os.path.join(GENERATED_ODES_DIRECTORY, module_name + ".py")
+    if not os.path.exists(module_path):
+        os.makedirs(GENERATED_ODES_DIRECTORY, exist_ok=True)
+        temporary_path = "%s.%d.tmp" % (module_path, os.getpid())
+        with open(temporary_path, "w") as module_file:
+            module_file.write(source)
+        os.replace(temporary_path, module_path)
+    specification = importlib.util.spec_from_file_location(module_name, module_path)
+    module = sys.modules[module_name] = importlib.util.module_from_spec(specification)
+    specification.loader.exec_module(module)
+    return module.find_generated_derivatives
+
+
+def compile_generated_odes(source):
+    """
+    load a generated odes function, compiling it with numba if it is installed, and cache it, with the compiled version
+    also cached on disk so that later processes building the same model don't need to compile it again
+    """
+    if source not in GENERATED_ODES:
+        try:
+            function, cache = load_generated_odes_module(source), True
+        except OSError:
+
+            # numba can only cache functions defined in a file, so compile in memory if the module couldn't be written
+            namespace = {}
+            exec(compile(source, "<generated odes>", "exec"), {}, namespace)
+            function, cache = namespace["find_generated_derivatives"], False
+        GENERATED_ODES[source] = function if njit is None else njit(cache=cache, fastmath=True)(function)
+    return GENERATED_ODES[source]
+
+
+@lru_cache(maxsize=None)
 def find_stem(stratified_string):
     """
-    find the stem of the compartment name as the text leading up to the first occurrence of "X"
+    find the stem of the compartment name as the text leading up to the first occurrence of "X", remembered for each
+    name as the same names are parsed repeatedly through stratification
     """
     first_x_location = stratified_string.find("X")
     return stratified_string if first_x_location == -1 else stratified_string[: first_x_location]
@@ -36,30 +265,29 @@ def create_stratum_name(stratification_name, stratum_name):
     return "X%s_%s" % (stratification_name, str(stratum_name))
 
 
+@lru_cache(maxsize=None)
 def extract_x_positions(parameter):
     """
-    find the positions within a string which are X and return as list reversed, including length of list
+    find the positions within a string which are X and return as tuple, including length of string, remembered for
+    each string and returned as a tuple so that the stored positions can't be changed
     """
-    result = [loc for loc in range(len(parameter)) if parameter[loc] == "X"]
-    result.append(len(parameter))
-    return result
+    return tuple(loc for loc in range(len(parameter)) if parameter[loc] == "X") + (len(parameter),)
 
 
 def extract_reversed_x_positions(parameter):
     """
-    find the positions within a string which are X and return as list reversed, including length of list
+    find the positions within a string which are X and return as tuple reversed, including length of string
     """
-    result = extract_x_positions(parameter)
-    result.reverse()
-    return result
+    return extract_x_positions(parameter)[::-1]
 
 
-def increment_compartment(ode_equations, compartment_number, increment):
+@lru_cache(maxsize=None)
+def extract_x_prefixes(parameter):
     """
-    general method to increment the odes by a value specified as an argument
+    find the prefixes of a string leading up to each X and the whole string, from the base stem to the most stratified
+    form, remembered for each string so that the prefixes are only sliced out once
     """
-    ode_equations[compartment_number] += increment
-    return ode_equations
+    return tuple(parameter[: x_instance] for x_instance in extract_x_positions(parameter))
 
 
 def normalise_dict(value_dict):
@@ -93,6 +321,26 @@ def num_str(f):
     return str(f)
 
 
+def run_built_model(build_model, arguments):
+    """
+    build a model from a set of arguments and integrate it, kept at module level so that it can be sent to worker
+    processes
+    """
+    model = build_model(arguments)
+    model.run_model()
+    return model.outputs
+
+
+def run_sweep(build_model, argument_sets, max_workers=None):
+    """
+    build and integrate one model for each set of arguments in parallel processes, returning the outputs stacked by
+    argument set, time and compartment, with build_model a module-level function returning the model to be run, so that
+    only the function, its arguments and the outputs need to pass between processes
+    """
+    with ProcessPoolExecutor(max_workers) as executor:
+        return numpy.array(list(executor.map(partial(run_built_model, build_model), argument_sets)))
+
+
 def create_flowchart(model_object, strata=-1, stratify=True, name="flow_chart"):
     """
     use graphviz module to create flow diagram of compartments and intercompartmental flows.
@@ -146,8 +394,9 @@ def create_flowchart(model_object, strata=-1, stratify=True, name="flow_chart"):
             model_object.flow_diagram.node(label)
 
     # build the graph edges
-    for row in type_of_flow.iterrows():
-        model_object.flow_diagram.edge(row[1]["origin"], row[1]["to"], row[1]["parameter"])
+    for origin, to, parameter in zip(type_of_flow.origin.tolist(), type_of_flow.to.tolist(),
+                                     type_of_flow.parameter.tolist()):
+        model_object.flow_diagram.edge(origin, to, parameter)
     model_object.flow_diagram = apply_styles(model_object.flow_diagram, styles)
     model_object.flow_diagram.render(name)
 
@@ -157,15 +406,6 @@ class EpiModel:
     model construction methods
     """
 
-    def find_parameter_value(self, parameter_name, time):
-        """
-        find the value of a parameter with time-variant values trumping constant ones
-        """
-        if parameter_name in self.time_variants:
-            return self.time_variants[parameter_name](time)
-        else:
-            return self.parameters[parameter_name]
-
     def output_to_user(self, comment):
         """
         short function to save the if statement in every call to output some information, may be adapted later and was
@@ -184,35 +424,51 @@ class EpiModel:
         self.death_flows = pandas.DataFrame(columns=["type", "parameter", "origin", "implement"])
 
         # attributes with specific format that are independent of user inputs
-        self.tracked_quantities, self.output_connections, self.time_variants = \
-            [{} for _ in range(3)]
+        self.output_connections, self.time_variants = [{} for _ in range(2)]
         self.derived_outputs = {"times": []}
+
+        # number of points to pre-calculate time-variant functions at for interpolation, zero to call them directly
+        self.time_variant_grid_points = 0
+        self.time_variant_grid, self.time_variant_grid_values = None, {}
+
+        # method for solve_ivp, with stiff methods given the analytic jacobian, though as they take longer steps the
+        # equilibrium stopping condition can be met during a lull before later changes in the time-variant functions
+        self.solve_ivp_method = "RK45"
         self.compartment_values, self.compartment_names = \
             [[] for _ in range(2)]
 
         # features that should not be changed
-        self.available_birth_approaches = ["add_crude_birth_rate", "replace_deaths", "no_births"]
-
-        # ensure requests are fed in correctly
-        self.check_and_report_attributes(
-            times, compartment_types, initial_conditions, parameters, requested_flows, initial_conditions_to_total,
-            infectious_compartment, birth_approach, report, reporting_sigfigs, entry_compartment,
-            starting_population, default_starting_compartment, equilibrium_stopping_tolerance, integration_type)
-
-        # stop ide complaining about attributes being defined outside __init__, even though they aren't
-        self.times, self.compartment_types, self.initial_conditions, self.parameters, self.requested_flows, \
-            self.initial_conditions_to_total, self.infectious_compartment, self.birth_approach, self.report, \
-            self.reporting_sigfigs, self.entry_compartment, self.starting_population, \
-            self.default_starting_compartment, self.default_starting_population, self.equilibrium_stopping_tolerance, \
-            self.unstratified_flows, self.outputs, self.integration_type, self.flow_diagram = [None for _ in range(19)]
-
-        # convert input arguments to model attributes
-        for attribute in ["times", "compartment_types", "initial_conditions", "parameters",
-                          "initial_conditions_to_total", "infectious_compartment", "birth_approach", "report",
-                          "reporting_sigfigs", "entry_compartment", "starting_population",
-                          "default_starting_compartment", "infectious_compartment", "equilibrium_stopping_tolerance",
-                          "integration_type"]:
-            setattr(self, attribute, eval(attribute))
+        self.available_birth_approaches = ["add_crude_birth_rate", "replace_deaths", "no_birth"]
+
+        # ensure requests are fed in correctly, only reporting on them if requested
+        self.check_attributes(
+            times, compartment_types, requested_flows, initial_conditions_to_total, infectious_compartment,
+            birth_approach, report, reporting_sigfigs, entry_compartment, starting_population,
+            default_starting_compartment, integration_type)
+        if report:
+            self.report_attributes(times, initial_conditions, infectious_compartment, birth_approach, reporting_sigfigs)
+
+        # convert input arguments to model attributes, keeping times as the array passed to the integrator
+        self.times = numpy.array(times)
+        if numpy.any(numpy.diff(self.times) < 0.):
+            self.times.sort()
+        self.compartment_types = compartment_types
+        self.initial_conditions = initial_conditions
+        self.parameters = parameters
+        self.initial_conditions_to_total = initial_conditions_to_total
+        self.infectious_compartment = infectious_compartment
+        self.birth_approach = birth_approach
+        self.report = report
+        self.reporting_sigfigs = reporting_sigfigs
+        self.entry_compartment = entry_compartment
+        self.starting_population = starting_population
+        self.default_starting_compartment = default_starting_compartment
+        self.equilibrium_stopping_tolerance = equilibrium_stopping_tolerance
+        self.integration_type = integration_type
+
+        # attributes that are only populated later
+        self.requested_flows, self.default_starting_population, self.unstratified_flows, self.outputs, \
+            self.flow_diagram, self.remainder_compartment = [None for _ in range(6)]
 
         # set initial conditions and implement flows
         self.set_initial_conditions(initial_conditions_to_total)
@@ -223,49 +479,50 @@ class EpiModel:
         # add any missing quantities that will be needed
         self.add_default_quantities()
 
-    def check_and_report_attributes(
-            self, times, compartment_types, initial_conditions, parameters, requested_flows,
-            initial_conditions_to_total, infectious_compartment, birth_approach, report, reporting_sigfigs,
-            entry_compartment, starting_population, default_starting_compartment, equilibrium_stopping_tolerance,
-            integration_type):
+    def check_attributes(
+            self, times, compartment_types, requested_flows, initial_conditions_to_total, infectious_compartment,
+            birth_approach, report, reporting_sigfigs, entry_compartment, starting_population,
+            default_starting_compartment, integration_type):
         """
         check all input data have been requested correctly
         """
 
         # check that variables are of the expected type
-        for expected_numeric_variable in ["reporting_sigfigs", "starting_population"]:
-            if not isinstance(eval(expected_numeric_variable), int):
-                raise TypeError("expected integer for %s" % expected_numeric_variable)
-        for expected_list in ["times", "compartment_types", "requested_flows"]:
-            if not isinstance(eval(expected_list), list):
-                raise TypeError("expected list for %s" % expected_list)
-        for expected_string in \
-                ["infectious_compartment", "birth_approach", "entry_compartment", "default_starting_compartment",
-                 "integration_type"]:
-            if not isinstance(eval(expected_string), str):
-                raise TypeError("expected string for %s" % expected_string)
-        for expected_boolean in ["initial_conditions_to_total", "report"]:
-            if not isinstance(eval(expected_boolean), bool):
-                raise TypeError("expected boolean for %s" % expected_boolean)
+        for value, expected_type, type_description, variable_name in (
+                (reporting_sigfigs, int, "integer", "reporting_sigfigs"),
+                (starting_population, int, "integer", "starting_population"),
+                (times, (list, numpy.ndarray), "list or array", "times"),
+                (compartment_types, list, "list", "compartment_types"),
+                (requested_flows, list, "list", "requested_flows"),
+                (infectious_compartment, str, "string", "infectious_compartment"),
+                (birth_approach, str, "string", "birth_approach"),
+                (entry_compartment, str, "string", "entry_compartment"),
+                (default_starting_compartment, str, "string", "default_starting_compartment"),
+                (integration_type, str, "string", "integration_type"),
+                (initial_conditions_to_total, bool, "boolean", "initial_conditions_to_total"),
+                (report, bool, "boolean", "report")):
+            if not isinstance(value, expected_type):
+                raise TypeError("expected %s for %s" % (type_description, variable_name))
 
         # check some specific requirements
         if infectious_compartment not in compartment_types:
-            ValueError("infectious compartment name is not one of the listed compartment types")
+            raise ValueError("infectious compartment name is not one of the listed compartment types")
         if birth_approach not in self.available_birth_approaches:
-            ValueError("requested birth approach unavailable")
-        if sorted(times) != times:
-            self.output_to_user("requested integration times are not sorted, now sorting")
-            self.times = sorted(self.times)
+            raise ValueError("requested birth approach unavailable")
 
-        # report on characteristics of inputs
-        if report:
-            print("integrating from time %s to %s"
-                  % (round(times[0], reporting_sigfigs), round(times[-1], reporting_sigfigs)))
-            print("unstratified requested initial conditions are:")
-            for compartment in initial_conditions:
-                print("\t%s: %s" % (compartment, initial_conditions[compartment]))
-            print("infectious compartment is called '%s'" % infectious_compartment)
-            print("birth approach is %s" % birth_approach)
+    def report_attributes(self, times, initial_conditions, infectious_compartment, birth_approach, reporting_sigfigs):
+        """
+        report on characteristics of inputs
+        """
+        if numpy.any(numpy.diff(times) < 0.):
+            print("requested integration times are not sorted, now sorting")
+        print("integrating from time %s to %s"
+              % (round(times[0], reporting_sigfigs), round(times[-1], reporting_sigfigs)))
+        print("unstratified requested initial conditions are:")
+        for compartment in initial_conditions:
+            print("\t%s: %s" % (compartment, initial_conditions[compartment]))
+        print("infectious compartment is called '%s'" % infectious_compartment)
+        print("birth approach is %s" % birth_approach)
 
     def set_initial_conditions(self, initial_conditions_to_total):
         """
@@ -273,10 +530,9 @@ class EpiModel:
         """
 
         # set starting values of unstratified compartments to requested value, or zero if no value requested
-        self.compartment_names = copy.copy(self.compartment_types)
-        self.compartment_values = [0.0] * len(self.compartment_names)
-        for compartment in [comp for comp in self.compartment_types if comp in self.initial_conditions]:
-            self.compartment_values[self.compartment_names.index(compartment)] = self.initial_conditions[compartment]
+        self.compartment_names = list(self.compartment_types)
+        self.compartment_values = \
+            [self.initial_conditions.get(compartment, 0.0) for compartment in self.compartment_names]
 
         # sum to a total value if requested
         if initial_conditions_to_total:
@@ -287,7 +543,7 @@ class EpiModel:
         make initial conditions sum to a certain value
         """
         compartment = self.find_remainder_compartment()
-        remaining_population = self.starting_population - sum(self.compartment_values)
+        remaining_population = self.starting_population - math.fsum(self.compartment_values)
         if remaining_population < 0.0:
             raise ValueError("total of requested compartment values is greater than the requested starting population")
         self.output_to_user("requested that total population sum to %s" % self.starting_population)
@@ -297,43 +553,51 @@ class EpiModel:
 
     def find_remainder_compartment(self):
         """
-        find the compartment to put the remaining population that hasn't been assigned yet when summing to total
+        find the compartment to put the remaining population that hasn't been assigned yet when summing to total,
+        storing it so that the checks and reporting are only done once
         """
-        if len(self.default_starting_compartment) > 0 and \
+        if self.remainder_compartment is not None:
+            return self.remainder_compartment
+        elif len(self.default_starting_compartment) > 0 and \
                 self.default_starting_compartment not in self.compartment_types:
             raise ValueError("starting compartment to populate with initial values not found in available compartments")
         elif len(self.default_starting_compartment) > 0:
-            return self.default_starting_compartment
+            self.remainder_compartment = self.default_starting_compartment
         else:
             self.output_to_user("no default starting compartment requested for unallocated population, " +
                                 "so will be allocated to entry compartment %s" % self.entry_compartment)
-            return self.entry_compartment
+            self.remainder_compartment = self.entry_compartment
+        return self.remainder_compartment
 
     def implement_flows(self, requested_flows):
         """
         add all flows to create data frames from input lists
         """
 
-        # check flow requested correctly
+        # check flow requested correctly, against a set as flows and compartments both grow with stratification
+        available_compartment_types = frozenset(self.compartment_types)
+        transition_flows, death_flows = [], []
         for flow in requested_flows:
             if flow["parameter"] not in self.parameters:
                 raise ValueError("flow parameter not found in parameter list")
-            if flow["origin"] not in self.compartment_types:
+            if flow["origin"] not in available_compartment_types:
                 raise ValueError("from compartment name not found in compartment types")
-            if "to" in flow and flow["to"] not in self.compartment_types:
+            if "to" in flow and flow["to"] not in available_compartment_types:
                 raise ValueError("to compartment name not found in compartment types")
 
-            # add flow to appropriate dataframe
+            # collect flow for appropriate dataframe, leaving the requested flow unchanged
             if flow["type"] == "compartment_death":
-                self.add_death_flow(flow)
+                death_flows.append(dict(flow, implement=0))
             else:
-                self.add_transition_flow(flow)
+                transition_flows.append(dict(flow, implement=0))
+
+        # build each dataframe once from all of its flows, rather than appending them one row at a time
+        self.transition_flows = pandas.concat(
+            [self.transition_flows, pandas.DataFrame(transition_flows)], ignore_index=True)
+        self.death_flows = pandas.concat([self.death_flows, pandas.DataFrame(death_flows)], ignore_index=True)
 
-            # add any tracked quantities that will be needed for calculating flow rates during integration
-            if "infection" in flow["type"]:
-                self.tracked_quantities["infectious_population"] = 0.0
-            if flow["type"] == "infection_frequency":
-                self.tracked_quantities["total_population"] = 0.0
+        # retain a copy of the original flows, as stratification then modifies the transition flows in place
+        self.unstratified_flows = self.transition_flows.copy()
 
     def add_default_quantities(self):
         """
@@ -347,29 +611,23 @@ class EpiModel:
         # birth approach-specific parameters
         if self.birth_approach == "add_crude_birth_rate" and "crude_birth_rate" not in self.parameters:
             self.parameters["crude_birth_rate"] = 0.0
-        elif self.birth_approach == "replace_deaths":
-            self.tracked_quantities["total_deaths"] = 0.0
-
-        # for each derived output to be recorded, initialise a tracked quantities key to zero
-        for output in self.output_connections:
-            self.tracked_quantities[output] = 0.0
 
         # parameters essential for stratification
         self.parameters["entry_fractions"] = 1.0
 
     def add_transition_flow(self, flow):
         """
-        simply add a flow to the pandas dataframe storing the flows
+        simply add a flow to the pandas dataframe storing the flows, leaving the requested flow unchanged
         """
-        flow["implement"] = 0
-        self.transition_flows = self.transition_flows.append(flow, ignore_index=True)
+        self.transition_flows = pandas.concat(
+            [self.transition_flows, pandas.DataFrame([dict(flow, implement=0)])], ignore_index=True)
 
     def add_death_flow(self, flow):
         """
         similarly for compartment-specific death flows
         """
-        flow["implement"] = 0
-        self.death_flows = self.death_flows.append(flow, ignore_index=True)
+        self.death_flows = pandas.concat(
+            [self.death_flows, pandas.DataFrame([dict(flow, implement=0)])], ignore_index=True)
 
     """
     methods for model running
@@ -381,181 +639,453 @@ class EpiModel:
         """
         self.output_to_user("now integrating")
         self.prepare_stratified_parameter_calculations()
+        self.prepare_flow_arrays()
+        self.prepare_parameter_arrays()
+
+        # fall back to odeint if compiled integration is requested but numbalsoda is not installed
+        integration_type = self.integration_type
+        if integration_type == "numbalsoda" and lsoda is None:
+            self.output_to_user("numbalsoda not available, integrating with odeint instead")
+            integration_type = "odeint"
+
+        # starting values converted once for all the integrators, and an odes buffer reused across evaluations by the
+        # integrators that copy out the values returned to them
+        initial_values = numpy.array(self.compartment_values, dtype=float)
+        ode_equations = numpy.zeros(len(self.compartment_names))
 
         # basic default integration method
-        if self.integration_type == "odeint":
+        if integration_type == "odeint":
             def make_model_function(compartment_values, time):
-                self.update_tracked_quantities(compartment_values)
-                return self.apply_all_flow_types_to_odes([0.0] * len(self.compartment_names), compartment_values, time)
-            self.outputs = odeint(make_model_function, self.compartment_values, self.times)
+                return self.apply_all_flow_types_to_odes(ode_equations, compartment_values, time)
+            self.outputs = odeint(make_model_function, initial_values, self.times,
+                                  Dfun=lambda compartment_values, time: self.find_jacobian(compartment_values, time))
 
         # alternative integration method
-        elif self.integration_type == "solve_ivp":
+        elif integration_type == "solve_ivp":
 
-            # solve_ivp requires arguments to model function in the reverse order
+            # solve_ivp requires arguments to model function in the reverse order and keeps the arrays returned to it
             def make_model_function(time, compartment_values):
-                self.update_tracked_quantities(compartment_values)
-                return self.apply_all_flow_types_to_odes([0.0] * len(self.compartment_names), compartment_values, time)
+                return self.apply_all_flow_types_to_odes(
+                    numpy.zeros(len(self.compartment_names)), compartment_values, time)
 
             # add a stopping condition, which was the original purpose of using this integration approach
             def set_stopping_conditions(time, compartment_values):
-                self.update_tracked_quantities(compartment_values)
-                net_flows = \
-                    self.apply_all_flow_types_to_odes([0.0] * len(self.compartment_names), compartment_values, time)
-                return max(list(map(abs, net_flows))) - self.equilibrium_stopping_tolerance
+                net_flows = self.apply_all_flow_types_to_odes(
+                    numpy.zeros(len(self.compartment_names)), compartment_values, time)
+                return numpy.abs(net_flows).max() - self.equilibrium_stopping_tolerance
             set_stopping_conditions.terminal = True
 
-            # solve_ivp returns more detailed structure, with (transposed) outputs (called "y") being just one component
-            self.outputs = solve_ivp(
-                make_model_function,
-                (self.times[0], self.times[-1]), self.compartment_values, t_eval=self.times,
-                events=set_stopping_conditions)["y"].transpose()
+            # solve_ivp returns more detailed structure, with (transposed) outputs (called "y") being just one
+            # component, with the analytic jacobian for the implicit methods so that they don't need finite differences
+            options = {"jac": lambda time, compartment_values: self.find_jacobian(compartment_values, time)} \
+                if self.solve_ivp_method in ("Radau", "BDF", "LSODA") else {}
+            solution = solve_ivp(
+                make_model_function, (self.times[0], self.times[-1]), initial_values, method=self.solve_ivp_method,
+                t_eval=self.times, events=set_stopping_conditions, **options)
+            self.outputs = solution["y"].transpose()
+
+        # lsoda through scipy's lower-level interface, which avoids solve_ivp's python-level step control
+        elif integration_type == "lsoda":
+            def make_model_function(time, compartment_values):
+                return self.apply_all_flow_types_to_odes(ode_equations, compartment_values, time)
+            integrator = ode(make_model_function, lambda time, compartment_values:
+                             self.find_jacobian(compartment_values, time)).set_integrator("lsoda")
+            integrator.set_initial_value(initial_values, self.times[0])
+            self.outputs = numpy.zeros((len(self.times), len(self.compartment_names)))
+            self.outputs[0] = initial_values
+            for n_time in range(1, len(self.times)):
+                self.outputs[n_time] = integrator.integrate(self.times[n_time])
+                if not integrator.successful():
+                    raise ValueError("integration failed at time %s" % self.times[n_time])
+
+        # fixed-step fourth order runge-kutta over the compiled odes
+        elif integration_type == "rk4":
+            self.outputs = integrate_packed_rk4(
+                initial_values, numpy.array(self.times, dtype=float), self.pack_model(), RK4_SUBSTEPS)
+
+        # compiled odes integrated by lsoda without returning to python at each evaluation
+        elif integration_type == "numbalsoda":
+            self.outputs = self.integrate_compiled_odes(initial_values)
+
+        # odeint with odes generated as straight-line code for this model's flows
+        elif integration_type == "generated":
+            find_generated_derivatives = compile_generated_odes(self.generate_odes_source())
+            self.outputs = odeint(
+                lambda compartment_values, time:
+                find_generated_derivatives(
+                    compartment_values, ode_equations, self.find_parameter_values(time), self.crude_birth_rate),
+                initial_values, self.times,
+                Dfun=lambda compartment_values, time: self.find_jacobian(compartment_values, time))
 
         else:
             raise ValueError("integration approach requested not available")
         self.output_to_user("integration complete")
+        self.find_derived_outputs()
 
-    def prepare_stratified_parameter_calculations(self):
+    def integrate_compiled_odes(self, initial_values):
         """
-        for use in the stratified version only
+        integrate with numbalsoda, packing the model into arrays for the compiled odes
         """
-        pass
 
-    def apply_all_flow_types_to_odes(self, ode_equations, compartment_values, time):
-        """
-        apply all flow types to a vector of zeros (deaths must come before births in case births replace deaths)
-        """
-        ode_equations = self.apply_transition_flows(ode_equations, compartment_values, time)
-        ode_equations = self.apply_compartment_death_flows(ode_equations, compartment_values, time)
-        ode_equations = self.apply_universal_death_flow(ode_equations, compartment_values, time)
-        return self.apply_birth_rate(ode_equations, compartment_values, time)
+        # tolerances matched to odeint's defaults
+        outputs, success = lsoda(compile_packed_odes().address, initial_values,
+                                 numpy.array(self.times, dtype=float), rtol=1.49012e-8, atol=1.49012e-8,
+                                 data=self.pack_model())
+        if not success:
+            raise ValueError("integration failed")
+        return outputs
 
-    def apply_transition_flows(self, ode_equations, compartment_values, time):
+    def pack_model(self):
         """
-        add fixed or infection-related flow to odes
+        pack the model into a single array for the compiled odes, so that time-variant functions can only be evaluated
+        by interpolating from their pre-calculated grid
         """
-        for f in self.transition_flows[self.transition_flows.implement == len(self.strata)].index:
-
-            # find adjusted parameter value
-            adjusted_parameter = self.get_parameter_value(self.transition_flows.parameter[f], time)
-
-            # find from compartment and "infectious population", which is 1 for standard flows
-            infectious_population = self.find_infectious_multiplier(self.transition_flows.type[f])
+        grid_times = self.time_variant_grid if self.parameter_time_variants else numpy.zeros(1)
+        grid_values = numpy.zeros((len(self.parameter_time_variants), len(grid_times)))
+        for n_time_variant, time_variant in enumerate(self.parameter_time_variants):
+            grid_values[n_time_variant] = self.time_variant_grid_values[time_variant]
 
-            # calculate the flow and apply to the odes
-            from_compartment = self.compartment_names.index(self.transition_flows.origin[f])
-            net_flow = adjusted_parameter * compartment_values[from_compartment] * infectious_population
-            ode_equations = increment_compartment(ode_equations, from_compartment, -net_flow)
-            ode_equations = increment_compartment(
-                ode_equations, self.compartment_names.index(self.transition_flows.to[f]), net_flow)
-
-            # track any quantities dependent on flow rates
-            self.track_derived_outputs(f, net_flow)
-
-        # add another element to the derived outputs vector
-        self.extend_derived_outputs(time)
-
-        # return flow rates
-        return ode_equations
+        # pack the model arrays to be passed to the odes, which are compiled once for all models
+        return pack_model_arrays(
+            [self.entry_fractions, self.infectious_weights, grid_times, grid_values.ravel(), self.parameter_constants,
+             self.component_parameters, self.component_time_variants, self.transition_origins,
+             self.transition_destinations, self.transition_parameter_indices, self.transition_type_codes,
+             self.death_origins, self.death_parameter_indices,
+             [self.universal_death_rate_index, self.birth_code, self.crude_birth_rate]])
 
-    def track_derived_outputs(self, n_flow, net_flow):
+    def run_model_batch(self, parameter_sets, substeps=RK4_SUBSTEPS):
         """
-        calculate derived quantities to be tracked
+        integrate the model once for each set of parameter values updating those of the model, advancing all the sets
+        together as arrays with a fixed-step fourth order runge-kutta scheme taking substeps steps between output
+        times, and return the outputs indexed by parameter set, time and compartment
         """
-        for output_type in self.output_connections:
-            if self.output_connections[output_type]["origin"] in self.transition_flows.origin[n_flow] \
-                    and self.output_connections[output_type]["to"] in self.transition_flows.to[n_flow]:
-                self.tracked_quantities[output_type] += net_flow
+        self.prepare_stratified_parameter_calculations()
+        self.prepare_flow_arrays()
+
+        # constant part of each flow parameter for each set, with the time-variant part shared by all sets
+        model_parameters, parameter_constants, crude_birth_rates = self.parameters, [], []
+        try:
+            for parameter_set in parameter_sets:
+                self.parameters = dict(model_parameters, **parameter_set)
+                self.prepare_stratified_parameter_calculations()
+                self.prepare_parameter_arrays()
+                parameter_constants.append(self.parameter_constants)
+                crude_birth_rates.append(self.parameters.get("crude_birth_rate", 0.0))
+        finally:
+            self.parameters = model_parameters
+            self.prepare_stratified_parameter_calculations()
+            self.prepare_parameter_arrays()
+        parameter_constants, crude_birth_rates = numpy.array(parameter_constants), numpy.array(crude_birth_rates)
+
+        # flows as sparse incidence matrices of compartments by flows, so that the flows of all the sets are applied to
+        # the odes together
+        n_compartments, n_transitions = len(self.compartment_names), len(self.transition_origins)
+        transition_matrix = csr_matrix(
+            (numpy.repeat([1.0, -1.0], n_transitions),
+             (numpy.concatenate((self.transition_destinations, self.transition_origins)),
+              numpy.tile(numpy.arange(n_transitions), 2))),
+            shape=(n_compartments, n_transitions))
+        death_matrix = csr_matrix(
+            (numpy.ones(len(self.death_origins)), (self.death_origins, numpy.arange(len(self.death_origins)))),
+            shape=(n_compartments, len(self.death_origins)))
+
+        def find_batch_derivatives(time, compartment_values):
+            parameter_values = parameter_constants.copy()
+            time_variant_values = numpy.array(
+                [self.find_time_variant_value(time_variant, time) for time_variant in self.parameter_time_variants])
+            numpy.multiply.at(parameter_values, (slice(None), self.component_parameters),
+                              time_variant_values[self.component_time_variants])
+            infectious_population = compartment_values @ self.infectious_weights
+            total_population = compartment_values.sum(axis=1)
+            infectious_multipliers = numpy.column_stack(
+                (numpy.ones(len(compartment_values)), infectious_population, infectious_population / total_population))
+            transition_flows = parameter_values[:, self.transition_parameter_indices] * \
+                infectious_multipliers[:, self.transition_type_codes] * compartment_values[:, self.transition_origins]
+            death_flows = parameter_values[:, self.death_parameter_indices] * compartment_values[:, self.death_origins]
+            universal_death_rates = parameter_values[:, self.universal_death_rate_index]
+            ode_equations = (transition_matrix @ transition_flows.T - death_matrix @ death_flows.T).T - \
+                universal_death_rates[:, numpy.newaxis] * compartment_values
+            if self.birth_approach == "add_crude_birth_rate":
+                total_births = crude_birth_rates * total_population
+            elif self.birth_approach == "replace_deaths":
+                total_births = death_flows.sum(axis=1) + universal_death_rates * total_population
+            else:
+                return ode_equations
+            return ode_equations + numpy.outer(total_births, self.entry_fractions)
+
+        outputs = numpy.zeros((len(parameter_constants), len(self.times), n_compartments))
+        outputs[:, 0] = self.compartment_values
+        compartment_values = outputs[:, 0].copy()
+        for n_time in range(1, len(self.times)):
+            time, step = self.times[n_time - 1], (self.times[n_time] - self.times[n_time - 1]) / substeps
+            for _ in range(substeps):
+                k1 = find_batch_derivatives(time, compartment_values)
+                k2 = find_batch_derivatives(time + step / 2.0, compartment_values + step / 2.0 * k1)
+                k3 = find_batch_derivatives(time + step / 2.0, compartment_values + step / 2.0 * k2)
+                k4 = find_batch_derivatives(time + step, compartment_values + step * k3)
+                compartment_values = compartment_values + step / 6.0 * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+                time += step
+            outputs[:, n_time] = compartment_values
+        return outputs
+
+    def generate_odes_source(self):
+        """
+        write the odes as straight-line code with the compartment and parameter indices of each flow written in
+        literally, so that nothing needs to be looked up from the flow arrays during integration
+        """
+        infectious_terms = ["%r * compartment_values[%d]" % (float(weight), n_compartment)
+                            for n_compartment, weight in enumerate(self.infectious_weights) if weight != 0.0]
+        source = [
+            "def find_generated_derivatives(compartment_values, ode_equations, parameter_values, crude_birth_rate):",
+            "    total_population = compartment_values.sum()",
+            "    infectious_population = %s" % (" + ".join(infectious_terms) if infectious_terms else "0.0"),
+            "    ode_equations[:] = -parameter_values[%d] * compartment_values" % self.universal_death_rate_index,
+            "    total_deaths = parameter_values[%d] * total_population" % self.universal_death_rate_index]
+
+        # infectious multipliers written out by the transition flow type codes
+        multipliers = ("", " * infectious_population", " * infectious_population / total_population")
+        for origin, destination, n_parameter, type_code in zip(
+                self.transition_origins, self.transition_destinations, self.transition_parameter_indices,
+                self.transition_type_codes):
+            source += ["    flow = parameter_values[%d] * compartment_values[%d]%s"
+                       % (n_parameter, origin, multipliers[type_code]),
+                       "    ode_equations[%d] -= flow" % origin,
+                       "    ode_equations[%d] += flow" % destination]
+        for origin, n_parameter in zip(self.death_origins, self.death_parameter_indices):
+            source += ["    flow = parameter_values[%d] * compartment_values[%d]" % (n_parameter, origin),
+                       "    ode_equations[%d] -= flow" % origin,
+                       "    total_deaths += flow"]
+
+        # births distributed over the entry compartments, with the crude birth rate passed in like the other parameter
+        # values so that the source only depends on the model structure
+        if self.birth_approach in ("add_crude_birth_rate", "replace_deaths"):
+            source.append("    total_births = %s" % (
+                "crude_birth_rate * total_population"
+                if self.birth_approach == "add_crude_birth_rate" else "total_deaths"))
+            source += ["    ode_equations[%d] += %r * total_births" % (n_compartment, float(fraction))
+                       for n_compartment, fraction in enumerate(self.entry_fractions) if fraction != 0.0]
+        source.append("    return ode_equations")
+        return "\n".join(source) + "\n"
 
-    def extend_derived_outputs(self, time):
+    def prepare_stratified_parameter_calculations(self):
         """
-        add the derived quantities being tracked to the end of the tracking vector
+        for use in the stratified version only
         """
-        self.derived_outputs["times"].append(time)
-        for output_type in self.output_connections:
-            self.derived_outputs[output_type].append(self.tracked_quantities[output_type])
+        pass
 
-    def apply_compartment_death_flows(self, ode_equations, compartment_values, time):
-        """
-        equivalent method to for transition flows above, but for deaths
-        """
-        for f in self.death_flows[self.death_flows.implement == len(self.strata)].index:
-            adjusted_parameter = self.get_parameter_value(self.death_flows.parameter[f], time)
-            from_compartment = self.compartment_names.index(self.death_flows.origin[f])
-            net_flow = adjusted_parameter * compartment_values[from_compartment]
-            ode_equations = increment_compartment(ode_equations, from_compartment, -net_flow)
-            if "total_deaths" in self.tracked_quantities:
-                self.tracked_quantities["total_deaths"] += net_flow
-        return ode_equations
+    def prepare_flow_arrays(self):
+        """
+        map the final compartment names to their indices and convert the columns of the flows to be implemented into
+        arrays of compartment indices, parameters and flow types, so that neither the compartment names nor the flow
+        data frames need to be searched during integration
+        """
+        self.compartment_indices = {compartment: n for n, compartment in enumerate(self.compartment_names)}
+        transition_flows = self.transition_flows[self.transition_flows.implement == len(self.strata)]
+        self.transition_origins = transition_flows.origin.map(self.compartment_indices).to_numpy(dtype=int)
+        self.transition_destinations = transition_flows.to.map(self.compartment_indices).to_numpy(dtype=int)
+        self.transition_parameters = transition_flows.parameter.tolist()
+        self.transition_type_codes = transition_flows.type.map(
+            {flow_type: n for n, flow_type in enumerate(TRANSITION_FLOW_TYPES)}).fillna(0).to_numpy(dtype=int)
+        self.transition_type_codes_used = sorted(set(self.transition_type_codes))
+        death_flows = self.death_flows[self.death_flows.implement == len(self.strata)]
+        self.death_origins = death_flows.origin.map(self.compartment_indices).to_numpy(dtype=int)
+        self.death_parameters = death_flows.parameter.tolist()
+        self.compartment_stems = [find_stem(compartment) for compartment in self.compartment_names]
+        self.infectious_compartments = numpy.array(
+            [stem == self.infectious_compartment for stem in self.compartment_stems], dtype=bool)
+        self.infectious_weights = self.find_infectious_weights()
+        self.entry_fractions = self.find_entry_fractions()
+        self.birth_code = {"add_crude_birth_rate": 1, "replace_deaths": 2}.get(self.birth_approach, 0)
+        self.crude_birth_rate = float(self.parameters.get("crude_birth_rate", 0.0))
+
+    def prepare_parameter_arrays(self):
+        """
+        give each parameter used by the flows a position in an array of values, split into an array of constant values
+        and the time-variant functions that each position is multiplied by during integration
+        """
+        self.flow_parameters = list(dict.fromkeys(
+            self.transition_parameters + self.death_parameters + ["universal_death_rate"]))
+        flow_parameter_indices = {parameter: n for n, parameter in enumerate(self.flow_parameters)}
+        self.transition_parameter_indices = \
+            numpy.array([flow_parameter_indices[parameter] for parameter in self.transition_parameters], dtype=int)
+        self.death_parameter_indices = \
+            numpy.array([flow_parameter_indices[parameter] for parameter in self.death_parameters], dtype=int)
+        self.universal_death_rate_index = flow_parameter_indices["universal_death_rate"]
+        self.prepare_time_variant_grid()
+
+        # split each flow parameter into its constant value and the time-variant functions it is multiplied by
+        self.parameter_constants, component_parameters, component_time_variants = [], [], []
+        self.parameter_time_variants = []
+        for n_parameter, parameter in enumerate(self.flow_parameters):
+            constant_value, parameter_time_variants = self.split_parameter(parameter)
+            self.parameter_constants.append(constant_value)
+            for time_variant in parameter_time_variants:
+                if time_variant not in self.parameter_time_variants:
+                    self.parameter_time_variants.append(time_variant)
+                component_parameters.append(n_parameter)
+                component_time_variants.append(self.parameter_time_variants.index(time_variant))
+        self.parameter_constants = numpy.array(self.parameter_constants, dtype=float)
+        self.component_parameters = numpy.array(component_parameters, dtype=int)
+        self.component_time_variants = numpy.array(component_time_variants, dtype=int)
+        self.parameter_values = self.parameter_constants.copy()
+        self.parameter_values_time = None
+
+    def prepare_time_variant_grid(self):
+        """
+        evaluate each time-variant function once over a grid spanning the integration period if requested, so that
+        integration only needs to interpolate between the pre-calculated values
+        """
+        self.time_variant_grid_values = {}
+        grid_points = self.find_time_variant_grid_points()
+        if grid_points > 0:
+            self.time_variant_grid = numpy.linspace(self.times[0], self.times[-1], grid_points)
+            for time_variant in self.time_variants:
+                self.time_variant_grid_values[time_variant] = \
+                    numpy.array([self.time_variants[time_variant](time) for time in self.time_variant_grid])
+
+    def find_time_variant_grid_points(self):
+        """
+        find the number of points to tabulate the time-variant functions at, which must be positive for the compiled
+        odes
+        """
+        if self.time_variant_grid_points == 0 and \
+                (self.integration_type == "numbalsoda" and lsoda is not None or self.integration_type == "rk4"):
+            return COMPILED_TIME_VARIANT_GRID_POINTS
+        return self.time_variant_grid_points
+
+    def find_time_variant_value(self, time_variant, time):
+        """
+        evaluate a time-variant function, interpolating from the grid of pre-calculated values if one has been built
+        """
+        if time_variant in self.time_variant_grid_values:
+            return numpy.interp(time, self.time_variant_grid, self.time_variant_grid_values[time_variant])
+        return self.time_variants[time_variant](time)
+
+    def split_parameter(self, parameter):
+        """
+        split a parameter into its constant value and the time-variant functions that it is the product of
+        """
+        return (1.0, [parameter]) if parameter in self.time_variants else (self.parameters[parameter], [])
+
+    def find_infectious_weights(self):
+        """
+        find the contribution of each compartment to the infectious population
+        """
+        return self.infectious_compartments.astype(float)
+
+    def find_entry_fractions(self):
+        """
+        find the proportion of all births that enter each compartment
+        """
+        entry_fractions = numpy.zeros(len(self.compartment_names))
+        entry_fractions[self.compartment_indices[self.entry_compartment]] = 1.0
+        return entry_fractions
 
-    def apply_universal_death_flow(self, ode_equations, compartment_values, time):
+    def apply_all_flow_types_to_odes(self, ode_equations, compartment_values, time):
         """
-        apply the population-wide death rate to all compartments
+        apply all flow types to the odes with the compiled kernel, from the parameter values at the time being evaluated
         """
-        for compartment in self.compartment_names:
-            adjusted_parameter = self.get_parameter_value("universal_death_rate", time)
-            from_compartment = self.compartment_names.index(compartment)
-            net_flow = adjusted_parameter * compartment_values[from_compartment]
-            ode_equations = increment_compartment(ode_equations, from_compartment, -net_flow)
-
-            # track deaths in case births are meant to replace deaths
-            if "total_deaths" in self.tracked_quantities:
-                self.tracked_quantities["total_deaths"] += net_flow
+        find_odes(ode_equations, compartment_values, self.find_parameter_values(time), self.transition_origins,
+                  self.transition_destinations, self.transition_parameter_indices, self.transition_type_codes,
+                  self.death_origins, self.death_parameter_indices, self.universal_death_rate_index,
+                  self.infectious_weights, self.entry_fractions, self.birth_code, self.crude_birth_rate)
         return ode_equations
 
-    def apply_birth_rate(self, ode_equations, compartment_values, time):
-        """
-        apply a birth rate to the entry compartments
-        """
-        return increment_compartment(ode_equations, self.compartment_names.index(self.entry_compartment),
-                                     self.find_total_births(compartment_values))
-
-    def find_total_births(self, compartment_values):
-        """
-        work out the total births to apply dependent on the approach requested
-        """
+    def find_parameter_values(self, time):
+        """
+        find the values of all the flow parameters, only recalculating them when the time being evaluated has changed,
+        by evaluating each time-variant function once and multiplying the constant values through by them together
+        """
+        if time != self.parameter_values_time and len(self.parameter_time_variants) > 0:
+            time_variant_values = numpy.array(
+                [self.find_time_variant_value(time_variant, time) for time_variant in self.parameter_time_variants])
+            self.parameter_values = self.parameter_constants.copy()
+            numpy.multiply.at(
+                self.parameter_values, self.component_parameters, time_variant_values[self.component_time_variants])
+            self.parameter_values_time = time
+        return self.parameter_values
+
+    def find_jacobian(self, compartment_values, time):
+        """
+        find the analytic jacobian of the odes, with each flow linear in its origin compartment and infection flows also
+        depending on the infectious population and, for frequency-dependent transmission, the total population
+        """
+        jacobian = numpy.zeros((len(self.compartment_names), len(self.compartment_names)))
+        parameter_values = self.find_parameter_values(time)
+        infectious_population = compartment_values @ self.infectious_weights
+        total_population = compartment_values.sum()
+
+        # transition flows with respect to their origin compartments, with infectious multipliers indexed by the flow
+        # type codes as for the odes
+        transition_parameter_values = parameter_values[self.transition_parameter_indices]
+        infectious_multipliers = numpy.array([1.0, infectious_population, infectious_population / total_population])
+        flow_rates = transition_parameter_values * infectious_multipliers[self.transition_type_codes]
+        numpy.add.at(jacobian, (self.transition_destinations, self.transition_origins), flow_rates)
+        numpy.add.at(jacobian, (self.transition_origins, self.transition_origins), -flow_rates)
+
+        # infection flows with respect to the compartments determining their infectious multipliers
+        for type_code in self.transition_type_codes_used:
+            if TRANSITION_FLOW_TYPES[type_code] == "infection_density":
+                multiplier_gradient = self.infectious_weights
+            elif TRANSITION_FLOW_TYPES[type_code] == "infection_frequency":
+                multiplier_gradient = \
+                    (self.infectious_weights - infectious_population / total_population) / total_population
+            else:
+                continue
+            flows = self.transition_type_codes == type_code
+            flow_gradients = numpy.outer(
+                transition_parameter_values[flows] * compartment_values[self.transition_origins[flows]],
+                multiplier_gradient)
+            numpy.add.at(jacobian, self.transition_destinations[flows], flow_gradients)
+            numpy.add.at(jacobian, self.transition_origins[flows], -flow_gradients)
+
+        # compartment-specific and universal deaths
+        death_rates = parameter_values[self.death_parameter_indices]
+        numpy.add.at(jacobian, (self.death_origins, self.death_origins), -death_rates)
+        universal_death_rate = parameter_values[self.universal_death_rate_index]
+        jacobian[numpy.diag_indices_from(jacobian)] -= universal_death_rate
+
+        # births, distributed over the entry compartments
         if self.birth_approach == "add_crude_birth_rate":
-            return self.parameters["crude_birth_rate"] * sum(compartment_values)
+            jacobian += numpy.outer(self.entry_fractions, self.crude_birth_rate)
         elif self.birth_approach == "replace_deaths":
-            return self.tracked_quantities["total_deaths"]
-        else:
-            return 0.0
-
-    def find_infectious_multiplier(self, flow_type):
-        """
-        find the multiplier to account for the infectious population in dynamic flows
-        """
-        if flow_type == "infection_density":
-            return self.tracked_quantities["infectious_population"]
-        elif flow_type == "infection_frequency":
-            return self.tracked_quantities["infectious_population"] / self.tracked_quantities["total_population"]
-        else:
-            return 1
-
-    def update_tracked_quantities(self, compartment_values):
-        """
-        update quantities that emerge during model running (not pre-defined functions of time)
-        """
-        for quantity in self.tracked_quantities:
-            self.tracked_quantities[quantity] = 0.0
-            if quantity == "infectious_population":
-                self.find_infectious_population(compartment_values)
-            elif quantity == "total_population":
-                self.tracked_quantities["total_population"] = sum(compartment_values)
-
-    def find_infectious_population(self, compartment_values):
-        """
-        calculations to find the effective infectious population
-        """
-        for compartment in [comp for comp in self.compartment_names if find_stem(comp) == self.infectious_compartment]:
-            self.tracked_quantities["infectious_population"] += \
-                compartment_values[self.compartment_names.index(compartment)]
-
-    def get_parameter_value(self, parameter, time):
-        """
-        very simple, but need to split this out as a function in order to allow stratification later
-        """
-        return self.find_parameter_value(parameter, time)
+            jacobian += numpy.outer(
+                self.entry_fractions,
+                numpy.bincount(self.death_origins, death_rates, len(self.compartment_names)) + universal_death_rate)
+        return jacobian
+
+    def find_derived_outputs(self):
+        """
+        calculate the derived quantities from the transition flows at each output time after integration, rather than
+        at every evaluation of the odes by the integrator
+        """
+        n_times = len(self.outputs)
+        self.derived_outputs = {"times": self.times[: n_times]}
+        if not self.output_connections:
+            return
+
+        # flow parameter values at each output time, evaluating each time-variant function once for each time
+        parameter_values = numpy.tile(self.parameter_constants, (n_times, 1))
+        time_variant_values = numpy.array(
+            [[self.find_time_variant_value(time_variant, time) for time_variant in self.parameter_time_variants]
+             for time in self.derived_outputs["times"]]).reshape(n_times, len(self.parameter_time_variants))
+        numpy.multiply.at(parameter_values, (slice(None), self.component_parameters),
+                          time_variant_values[:, self.component_time_variants])
+
+        # net transition flows at each output time, with infectious multipliers indexed by the flow type codes
+        infectious_population = self.outputs @ self.infectious_weights
+        infectious_multipliers = numpy.column_stack(
+            (numpy.ones(n_times), infectious_population, infectious_population / self.outputs.sum(axis=1)))
+        net_flows = parameter_values[:, self.transition_parameter_indices] * \
+            infectious_multipliers[:, self.transition_type_codes] * self.outputs[:, self.transition_origins]
+
+        # sum the transition flows that contribute to each derived output
+        for output_type in self.output_connections:
+            connected_flows = numpy.array(
+                [self.output_connections[output_type]["origin"] in self.compartment_names[origin] and
+                 self.output_connections[output_type]["to"] in self.compartment_names[to]
+                 for origin, to in zip(self.transition_origins, self.transition_destinations)], dtype=bool)
+            self.derived_outputs[output_type] = net_flows[:, connected_flows].sum(axis=1)
 
     def store_database(self):
         """
@@ -578,10 +1108,23 @@ class StratifiedModel(EpiModel):
         """
         remove a compartment by taking the element out of the compartment values attribute
         """
-        self.removed_compartments.append(compartment)
-        del self.compartment_values[self.compartment_names.index(compartment)]
-        del self.compartment_names[self.compartment_names.index(compartment)]
-        self.output_to_user("removing compartment: %s" % compartment)
+        self.remove_compartments([compartment])
+
+    def remove_compartments(self, compartments):
+        """
+        remove several compartments together, filtering the compartment names and values in a single pass rather than
+        searching for and deleting each compartment in turn
+        """
+        compartments_to_remove = frozenset(compartments)
+        if not compartments_to_remove.issubset(self.compartment_names):
+            raise ValueError("compartment to be removed not found in model compartments")
+        retained = [n for n, compartment in enumerate(self.compartment_names)
+                    if compartment not in compartments_to_remove]
+        self.compartment_values = [self.compartment_values[n] for n in retained]
+        self.compartment_names = [self.compartment_names[n] for n in retained]
+        for compartment in compartments:
+            self.removed_compartments.append(compartment)
+            self.output_to_user("removing compartment: %s" % compartment)
 
     def __init__(self, times, compartment_types, initial_conditions, parameters, requested_flows,
                  initial_conditions_to_total=True, infectious_compartment="infectious", birth_approach="no_birth",
@@ -596,8 +1139,9 @@ class StratifiedModel(EpiModel):
                           equilibrium_stopping_tolerance=equilibrium_stopping_tolerance,
                           integration_type=integration_type)
 
-        self.strata, self.removed_compartments, self.overwrite_parameters, self.compartment_types_to_stratify = \
-            [[] for _ in range(4)]
+        self.strata, self.removed_compartments = [[] for _ in range(2)]
+        self.compartment_types_to_stratify = frozenset()
+        self.overwrite_parameters = set()
         self.heterogeneous_infectiousness = False
         self.infectiousness_adjustments, self.parameter_components = [{} for _ in range(2)]
 
@@ -606,10 +1150,13 @@ class StratifiedModel(EpiModel):
     """
 
     def stratify(self, stratification_name, strata_request, compartment_types_to_stratify, adjustment_requests=(),
-                 requested_proportions={}, infectiousness_adjustments=(), report=True):
+                 requested_proportions=None, infectiousness_adjustments=(), report=True):
         """
         initial preparation and checks
         """
+
+        # a shared default dictionary would be filled in by one stratification and leak into every later one
+        requested_proportions = {} if requested_proportions is None else requested_proportions
         strata_names, adjustment_requests = self.prepare_and_check_stratification(
             stratification_name, strata_request, compartment_types_to_stratify, adjustment_requests, report)
 
@@ -705,13 +1252,14 @@ class StratifiedModel(EpiModel):
         if len(compartment_types_to_stratify) == 0:
             self.output_to_user("no compartment names specified for this stratification, " +
                                 "so stratification applied to all model compartments")
-            self.compartment_types_to_stratify = self.compartment_types
+            self.compartment_types_to_stratify = frozenset(self.compartment_types)
 
-        # otherwise check all the requested compartments are available and implement the user request
-        elif any([compartment not in self.compartment_types for compartment in self.compartment_types_to_stratify]):
+        # otherwise check all the requested compartments are available and implement the user request, as a set as
+        # it is only used to test whether compartments are to be stratified
+        elif any([compartment not in self.compartment_types for compartment in compartment_types_to_stratify]):
             raise ValueError("requested compartment or compartments to be stratified are not available in this model")
         else:
-            self.compartment_types_to_stratify = compartment_types_to_stratify
+            self.compartment_types_to_stratify = frozenset(compartment_types_to_stratify)
 
     def alternative_adjustment_request(self, adjustment_requests):
         """
@@ -771,27 +1319,34 @@ class StratifiedModel(EpiModel):
         compartment stratification
         """
 
-        # find the existing compartments that need stratification
-        for compartment in \
-                [comp for comp in self.compartment_names if find_stem(comp) in self.compartment_types_to_stratify]:
-
-            # add and remove compartments
-            for stratum in strata_names:
+        # find the existing compartments that need stratification, with their values mapped by name rather than
+        # searching for each one as compartments are added
+        compartment_values = dict(zip(self.compartment_names, self.compartment_values))
+        compartments_to_stratify = \
+            [comp for comp in self.compartment_names if find_stem(comp) in self.compartment_types_to_stratify]
+        strata_proportions = [(stratum, requested_proportions[stratum]) for stratum in strata_names]
+        for compartment in compartments_to_stratify:
+            compartment_value = compartment_values[compartment]
+            for stratum, proportion in strata_proportions:
                 self.add_compartment(
-                    create_stratified_name(compartment, stratification_name, stratum),
-                    self.compartment_values[self.compartment_names.index(compartment)] * requested_proportions[stratum])
-            self.remove_compartment(compartment)
+                    create_stratified_name(compartment, stratification_name, stratum), compartment_value * proportion)
+
+        # remove the unstratified compartments together, leaving the same order as removing each after stratifying it
+        self.remove_compartments(compartments_to_stratify)
 
     def stratify_transition_flows(self, stratification_name, strata_names, adjustment_requests):
         """
         stratify flows depending on whether inflow, outflow or both need replication
         """
-        for flow in self.transition_flows[self.transition_flows.implement == len(self.strata) - 1].index:
-            self.add_stratified_flows(
+        new_flows, n_strata = [], len(self.strata)
+        for flow in self.transition_flows[self.transition_flows.implement == n_strata - 1].itertuples():
+            new_flows += self.add_stratified_flows(
                 flow, stratification_name, strata_names,
-                find_stem(self.transition_flows.origin[flow]) in self.compartment_types_to_stratify,
-                find_stem(self.transition_flows.to[flow]) in self.compartment_types_to_stratify,
+                find_stem(flow.origin) in self.compartment_types_to_stratify,
+                find_stem(flow.to) in self.compartment_types_to_stratify,
                 adjustment_requests)
+        self.transition_flows = pandas.concat(
+            [self.transition_flows, pandas.DataFrame(new_flows)], ignore_index=True)
         self.output_to_user("stratified transition flows matrix:\n%s" % self.transition_flows)
 
     def stratify_entry_flows(self, stratification_name, strata_names, requested_proportions):
@@ -823,18 +1378,19 @@ class StratifiedModel(EpiModel):
         """
         add compartment-specific death flows to death data frame
         """
-        for flow in self.death_flows[self.death_flows.implement == len(self.strata) - 1].index:
+        new_flows, n_strata = [], len(self.strata)
+        for flow in self.death_flows[self.death_flows.implement == n_strata - 1].itertuples():
             for stratum in strata_names:
                 parameter_name = self.add_adjusted_parameter(
-                    self.death_flows.parameter[flow], stratification_name, stratum, adjustment_requests)
+                    flow.parameter, stratification_name, stratum, adjustment_requests)
                 if not parameter_name:
-                    parameter_name = self.death_flows.parameter[flow]
-                self.death_flows = self.death_flows.append(
-                    {"type": self.death_flows.type[flow],
+                    parameter_name = flow.parameter
+                new_flows.append(
+                    {"type": flow.type,
                      "parameter": parameter_name,
-                     "origin": create_stratified_name(self.death_flows.origin[flow], stratification_name, stratum),
-                     "implement": len(self.strata)},
-                    ignore_index=True)
+                     "origin": create_stratified_name(flow.origin, stratification_name, stratum),
+                     "implement": n_strata})
+        self.death_flows = pandas.concat([self.death_flows, pandas.DataFrame(new_flows)], ignore_index=True)
 
     def stratify_universal_death_rate(self, stratification_name, strata_names, adjustment_requests):
         """
@@ -852,8 +1408,10 @@ class StratifiedModel(EpiModel):
         """
         parameter_adjustment_name = None
 
-        # find the adjustment request that is an extension of the base parameter type being considered
-        for parameter_request in [req for req in adjustment_requests if unadjusted_parameter.startswith(req)]:
+        # find the adjustment requests for the base parameter type or any of its stratified forms leading up to the
+        # parameter being considered, by looking up each of these in turn rather than scanning all the requests
+        for parameter_request in [
+                request for request in extract_x_prefixes(unadjusted_parameter) if request in adjustment_requests]:
             self.output_to_user(
                 "modifying %s for %s stratum of %s" % (unadjusted_parameter, stratum, stratification_name))
             parameter_adjustment_name = create_stratified_name(unadjusted_parameter, stratification_name, stratum)
@@ -865,7 +1423,7 @@ class StratifiedModel(EpiModel):
             # overwrite parameters higher up the tree by listing which ones to be overwritten
             if "overwrite" in adjustment_requests[parameter_request] and \
                     stratum in adjustment_requests[parameter_request]["overwrite"]:
-                self.overwrite_parameters.append(parameter_adjustment_name)
+                self.overwrite_parameters.add(parameter_adjustment_name)
         return parameter_adjustment_name
 
     def apply_heterogeneous_infectiousness(self, stratification_name, strata_request, infectiousness_adjustments):
@@ -888,6 +1446,7 @@ class StratifiedModel(EpiModel):
         """
         set intercompartmental flows for ageing from one stratum to the next
         """
+        ageing_flows, n_strata = [], len(self.strata)
         for stratum_number in range(len(strata_names[: -1])):
             start_age = int(strata_names[stratum_number])
             end_age = int(strata_names[stratum_number + 1])
@@ -897,30 +1456,31 @@ class StratifiedModel(EpiModel):
                                 % (start_age, end_age, round(ageing_rate, self.reporting_sigfigs)))
             self.parameters[ageing_parameter_name] = ageing_rate
             for compartment in self.compartment_names:
-                self.transition_flows = self.transition_flows.append(
+                ageing_flows.append(
                     {"type": "standard_flows",
                      "parameter": ageing_parameter_name,
                      "origin": create_stratified_name(compartment, "age", start_age),
                      "to": create_stratified_name(compartment, "age", end_age),
-                     "implement": len(self.strata)},
-                    ignore_index=True)
+                     "implement": n_strata})
+        self.transition_flows = pandas.concat(
+            [self.transition_flows, pandas.DataFrame(ageing_flows)], ignore_index=True)
 
     def add_stratified_flows(self, flow, stratification_name, strata_names, stratify_from, stratify_to,
                              adjustment_requests):
         """
-        add additional stratified flow to flow data frame
+        find the additional stratified flows to add to the flow data frame, from the row of the flow being stratified
         """
+        new_flows, n_strata = [], len(self.strata)
         if stratify_from or stratify_to:
             self.output_to_user(
-                "for flow from %s to %s in stratification %s"
-                % (self.transition_flows.origin[flow], self.transition_flows.to[flow], stratification_name))
+                "for flow from %s to %s in stratification %s" % (flow.origin, flow.to, stratification_name))
 
             # loop over each stratum in the requested stratification structure
             for stratum in strata_names:
 
                 # find parameter name
                 parameter_name = self.add_adjusted_parameter(
-                    self.transition_flows.parameter[flow], stratification_name, stratum, adjustment_requests)
+                    flow.parameter, stratification_name, stratum, adjustment_requests)
                 if not parameter_name:
                     parameter_name = self.sort_absent_parameter_request(
                         stratification_name, strata_names, stratum, stratify_from, stratify_to, flow)
@@ -928,20 +1488,18 @@ class StratifiedModel(EpiModel):
 
                 # determine whether to and/or from compartments are stratified
                 from_compartment = \
-                    create_stratified_name(self.transition_flows.origin[flow], stratification_name, stratum) if \
-                        stratify_from else self.transition_flows.origin[flow]
+                    create_stratified_name(flow.origin, stratification_name, stratum) if stratify_from else flow.origin
                 to_compartment = \
-                    create_stratified_name(self.transition_flows.to[flow], stratification_name, stratum) if \
-                        stratify_to else self.transition_flows.to[flow]
+                    create_stratified_name(flow.to, stratification_name, stratum) if stratify_to else flow.to
 
                 # add the new flow
-                self.transition_flows = self.transition_flows.append(
-                    {"type": self.transition_flows.type[flow],
+                new_flows.append(
+                    {"type": flow.type,
                      "parameter": parameter_name,
                      "origin": from_compartment,
                      "to": to_compartment,
-                     "implement": len(self.strata)},
-                    ignore_index=True)
+                     "implement": n_strata})
+        return new_flows
 
     def sort_absent_parameter_request(self, stratification_name, strata_names, stratum, stratify_from, stratify_to,
                                       flow):
@@ -952,14 +1510,13 @@ class StratifiedModel(EpiModel):
         # default behaviour if not specified is to split the parameter into equal parts if to compartment is split
         if not stratify_from and stratify_to:
             self.output_to_user("\tsplitting existing parameter value %s into %s equal parts"
-                                % (self.transition_flows.parameter[flow], len(strata_names)))
-            self.parameters[
-                create_stratified_name(self.transition_flows.parameter[flow], stratification_name, stratum)] = \
+                                % (flow.parameter, len(strata_names)))
+            self.parameters[create_stratified_name(flow.parameter, stratification_name, stratum)] = \
                 1.0 / len(strata_names)
 
         # otherwise if no request, retain the existing parameter
         else:
-            parameter_name = self.transition_flows.parameter[flow]
+            parameter_name = flow.parameter
             self.output_to_user("\tretaining existing parameter value %s" % parameter_name)
         return parameter_name
 
@@ -972,17 +1529,10 @@ class StratifiedModel(EpiModel):
         prior to integration commencing, work out what the components are of each parameter being implemented
         """
 
-        # create list of all the parameters that we need to find the list of adjustments for
-        parameters_to_adjust = []
-        for f in range(self.transition_flows.shape[0]):
-            if self.transition_flows.implement[f] == len(self.strata) and \
-                    self.transition_flows.parameter[f] not in parameters_to_adjust:
-                parameters_to_adjust.append(self.transition_flows.parameter[f])
-        for f in range(self.death_flows.shape[0]):
-            if self.death_flows.implement[f] == len(self.strata) and \
-                    self.death_flows.parameter[f] not in parameters_to_adjust:
-                parameters_to_adjust.append(self.death_flows.parameter[f])
-        parameters_to_adjust.append("universal_death_rate")
+        # create set of all the parameters that we need to find the list of adjustments for
+        parameters_to_adjust, n_strata = {"universal_death_rate"}, len(self.strata)
+        for flows in (self.transition_flows, self.death_flows):
+            parameters_to_adjust.update(flows.parameter[flows.implement == n_strata].tolist())
         for parameter in parameters_to_adjust:
             self.find_parameter_components(parameter)
 
@@ -992,84 +1542,66 @@ class StratifiedModel(EpiModel):
         """
 
         # collate all the parameter components into time-variant or constant
-        self.parameter_components[parameter] = {"time_variants": [], "constants": [], "constant_value": 1}
-        for x_instance in extract_reversed_x_positions(parameter):
-            component = parameter[: x_instance]
+        components = {"time_variants": [], "constants": [], "constant_value": 1}
+        for component in reversed(extract_x_prefixes(parameter)):
             is_time_variant = component in self.time_variants
             if component in self.overwrite_parameters and is_time_variant:
-                self.parameter_components[parameter] = \
-                    {"time_variants": [component], "constants": [], "constant_value": 1}
+                components = {"time_variants": [component], "constants": [], "constant_value": 1}
                 break
             elif component in self.overwrite_parameters and not is_time_variant:
-                self.parameter_components[parameter] = \
-                    {"time_variants": [], "constants": [component], "constant_value": 1}
+                components = {"time_variants": [], "constants": [component], "constant_value": 1}
                 break
             elif is_time_variant:
-                self.parameter_components[parameter]["time_variants"].append(component)
+                components["time_variants"].append(component)
             elif component in self.parameters:
-                self.parameter_components[parameter]["constants"].append(component)
+                components["constants"].append(component)
 
         # pre-calculate the constant component by multiplying through all the constant values
-        for constant_parameter in self.parameter_components[parameter]["constants"]:
-            self.parameter_components[parameter]["constant_value"] *= self.parameters[constant_parameter]
+        if components["constants"]:
+            components["constant_value"] = float(numpy.prod(
+                [self.parameters[constant_parameter] for constant_parameter in components["constants"]]))
+        self.parameter_components[parameter] = components
 
-    def get_parameter_value(self, parameter, time):
+    def split_parameter(self, parameter):
         """
-        calculate adjusted parameter value from pre-calculated product of constant components and time variants
+        split a stratified parameter into the product of its constant components and its time-variant components
         """
-        adjusted_parameter = self.parameter_components[parameter]["constant_value"]
-        for time_variant in self.parameter_components[parameter]["time_variants"]:
-            adjusted_parameter *= self.time_variants[time_variant](time)
-        return adjusted_parameter
+        return self.parameter_components[parameter]["constant_value"], \
+            self.parameter_components[parameter]["time_variants"]
 
-    def find_infectious_population(self, compartment_values):
+    def find_infectious_weights(self):
         """
-        calculations to find the effective infectious population
+        find the contribution of each compartment to the infectious population, allowing for heterogeneous
+        infectiousness
         """
+        infectious_weights = self.infectious_compartments.astype(float)
+        for n_compartment in numpy.flatnonzero(self.infectious_compartments):
+            compartment = self.compartment_names[n_compartment]
+            if self.heterogeneous_infectiousness:
+                for adjustment in [adj for adj in self.infectiousness_adjustments if adj in compartment]:
+                    infectious_weights[n_compartment] = self.infectiousness_adjustments[adjustment]
+        return infectious_weights
 
-        # loop through all compartments and find the ones representing active infectious disease
-        for compartment in self.compartment_names:
-            if find_stem(compartment) == self.infectious_compartment:
-
-                # assume homogeneous infectiousness until requested otherwise
-                infectiousness_modifier = 1.0
-
-                # haven't yet done heterogeneous infectiousness
-                if self.heterogeneous_infectiousness:
-                    for adjustment in [adj for adj in self.infectiousness_adjustments if adj in compartment]:
-                        infectiousness_modifier = self.infectiousness_adjustments[adjustment]
-
-                self.tracked_quantities["infectious_population"] += \
-                    compartment_values[self.compartment_names.index(compartment)] * \
-                    infectiousness_modifier
-
-    def apply_birth_rate(self, ode_equations, compartment_values, time):
+    def find_entry_fractions(self):
         """
-        apply a population-wide death rate to all compartments
+        find the proportion of all births that enter each compartment, from the entry fractions of each stratum
         """
-        total_births = self.find_total_births(compartment_values)
-
-        # split the total births across entry compartments
-        for compartment in self.compartment_names:
-            if find_stem(compartment) == self.entry_compartment:
-
-                # calculate adjustment to original stem entry rate
-                entry_fraction = 1.0
+        entry_fractions = numpy.zeros(len(self.compartment_names))
+        for n_compartment, (compartment, stem) in enumerate(zip(self.compartment_names, self.compartment_stems)):
+            if stem == self.entry_compartment:
+                entry_fractions[n_compartment] = 1.0
                 x_positions = extract_x_positions(compartment)
-
-                if len(x_positions) > 1:
-                    for x_instance in range(len(x_positions) - 1):
-                        entry_fraction *= \
-                            self.parameters["entry_fractionX%s"
-                                            % compartment[x_positions[x_instance] + 1: x_positions[x_instance + 1]]]
-                compartment_births = entry_fraction * total_births
-                ode_equations = increment_compartment(
-                    ode_equations, self.compartment_names.index(compartment), compartment_births)
-        return ode_equations
+                for x_instance in range(len(x_positions) - 1):
+                    entry_fractions[n_compartment] *= \
+                        self.parameters["entry_fractionX%s"
+                                        % compartment[x_positions[x_instance] + 1: x_positions[x_instance + 1]]]
+        return entry_fractions
 
 
 if __name__ == "__main__":
-    sir_model = StratifiedModel(numpy.linspace(0, 60 / 365, 61).tolist(),
+    import matplotlib.pyplot
+
+    sir_model = StratifiedModel(numpy.linspace(0, 60 / 365, 61),
                          ["susceptible", "infectious", "recovered"],
                          {"infectious": 0.001},
                          {"beta": 400, "recovery": 365 / 13, "infect_death": 1},
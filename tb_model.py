@@ -1,8 +1,20 @@
 
 import summer_model
 import numpy
-import matplotlib.pyplot
+import math
 import os
+import argparse
+from functools import lru_cache
+
+# latency parameters estimated by Ragonnet et al, per day
+VTP_LATENCY_PARAMETERS = \
+    {"early_progression": 1.1e-3,
+     "stabilisation": 1.0e-2,
+     "late_progression": 5.5e-6}
+AGE_STRATIFIED_LATENCY_PARAMETERS = \
+    {"early_progression": {"0W": 6.6e-3, "5W": 2.7e-3, "15W": 2.7e-4},
+     "stabilisation": {"0W": 1.2e-2, "5W": 1.2e-2, "15W": 5.4e-3},
+     "late_progression": {"0W": 1.9e-11, "5W": 6.4e-6, "15W": 3.3e-6}}
 
 
 def add_vtp_latency_parameters(parameters_, change_time_unit=365.25):
@@ -10,11 +22,7 @@ def add_vtp_latency_parameters(parameters_, change_time_unit=365.25):
     function to add the latency parameters estimated by Ragonnet et al from our paper in Epidemics to the existing
     parameter dictionary
     """
-    vtp_latency_parameters = \
-        {"early_progression": 1.1e-3,
-         "stabilisation": 1.0e-2,
-         "late_progression": 5.5e-6}
-    parameters_.update({key: value * change_time_unit for key, value in vtp_latency_parameters.items()})
+    parameters_.update({key: value * change_time_unit for key, value in VTP_LATENCY_PARAMETERS.items()})
     return parameters_
 
 
@@ -22,11 +30,7 @@ def get_age_specific_latency_parameters(parameter, unit_change=365.25):
     """
     get the age-specific latency parameters estimated by Ragonnet et al
     """
-    age_stratified_parameters = \
-        {"early_progression": {"0W": 6.6e-3, "5W": 2.7e-3, "15W": 2.7e-4},
-         "stabilisation": {"0W": 1.2e-2, "5W": 1.2e-2, "15W": 5.4e-3},
-         "late_progression": {"0W": 1.9e-11, "5W": 6.4e-6, "15W": 3.3e-6}}
-    return {key: value * unit_change for key, value in age_stratified_parameters[parameter].items()}
+    return {key: value * unit_change for key, value in AGE_STRATIFIED_LATENCY_PARAMETERS[parameter].items()}
 
 
 def get_all_age_specific_latency_parameters(parameters_=("early_progression", "stabilisation", "late_progression")):
@@ -50,19 +54,21 @@ def add_standard_latency_flows(flows_):
 def sinusoidal_scaling_function(start_time, baseline_value, end_time, final_value):
     """
     with a view to implementing scale-up functions over time, use the cosine function to produce smooth scale-up
-    functions from one point to another
+    functions from one point to another, with values remembered as the integrator revisits the same times
     """
+    if start_time > end_time:
+        raise ValueError("start time is later than end time")
+    amplitude = final_value - baseline_value
+    scaled_time = math.pi / (end_time - start_time) if end_time > start_time else 0.0
+
+    @lru_cache(maxsize=4096)
     def sinusoidal_function(x):
         if not isinstance(x, float):
             raise ValueError("value fed into scaling function not a float")
-        elif start_time > end_time:
-            raise ValueError("start time is later than end time")
         elif x < start_time:
             return baseline_value
         elif start_time < x < end_time:
-            return baseline_value + \
-                   (final_value - baseline_value) * \
-                   (0.5 - 0.5 * numpy.cos((x - start_time) * numpy.pi / (end_time - start_time)))
+            return baseline_value + amplitude * (0.5 - 0.5 * math.cos((x - start_time) * scaled_time))
         else:
             return final_value
     return sinusoidal_function
@@ -82,20 +88,25 @@ def return_function_of_function(inner_function, outer_function):
     return lambda value: outer_function(inner_function(value))
 
 
-if __name__ == "__main__":
+def build_tb_model(beta=10.0, times=(1800., 2020.0, 201)):
+    """
+    build the age-stratified tb model ready to be integrated, with the start, end and number of the integration times
+    given as for numpy.linspace
+    the structure only needs to be built once, as the model can be integrated repeatedly after updating the values in
+    its parameters, and as a module-level function it can be passed to summer_model.run_sweep
+    """
 
     # set basic parameters, flows and times, except for latency flows and parameters, then functionally add latency
     case_fatality_rate = 0.4
     untreated_disease_duration = 3.0
     parameters = \
-        {"beta": 10.0,
+        {"beta": beta,
          "recovery": case_fatality_rate / untreated_disease_duration,
          "infect_death": (1.0 - case_fatality_rate) / untreated_disease_duration,
          "universal_death_rate": 1.0 / 50.0,
          "case_detection": 0.0}
     parameters = add_vtp_latency_parameters(parameters)
 
-    times = numpy.linspace(1800., 2020.0, 201).tolist()
     flows = [{"type": "infection_frequency", "parameter": "beta", "origin": "susceptible", "to": "early_latent"},
              {"type": "infection_frequency", "parameter": "beta", "origin": "recovered", "to": "early_latent"},
              {"type": "standard_flows", "parameter": "recovery", "origin": "infectious", "to": "recovered"},
@@ -103,8 +114,8 @@ if __name__ == "__main__":
     flows = add_standard_latency_flows(flows)
 
     tb_model = summer_model.StratifiedModel(
-        times, ["susceptible", "early_latent", "late_latent", "infectious", "recovered"], {"infectious": 1e-3},
-        parameters, flows, birth_approach="replace_deaths")
+        numpy.linspace(*times), ["susceptible", "early_latent", "late_latent", "infectious", "recovered"],
+        {"infectious": 1e-3}, parameters, flows, birth_approach="replace_deaths")
 
     tb_model.add_transition_flow(
         {"type": "standard_flows", "parameter": "case_detection", "origin": "infectious", "to": "recovered"})
@@ -115,25 +126,40 @@ if __name__ == "__main__":
 
     tb_model.time_variants["case_detection"] = detect_rate
 
-    print(get_all_age_specific_latency_parameters())
     tb_model.stratify("age", [5, 15], [],
                       adjustment_requests=get_all_age_specific_latency_parameters(),
                       report=False)
+    return tb_model
+
+
+if __name__ == "__main__":
+
+    # plotting is optional so that batch runs neither load matplotlib nor block on the figure, and the outputs can be
+    # saved instead
+    parser = argparse.ArgumentParser(description="integrate the age-stratified tb model")
+    parser.add_argument("--plot", action="store_true", help="plot the infectious population")
+    parser.add_argument("--output", help="file to save the times and infectious population to, in numpy's npz format")
+    arguments = parser.parse_args()
+
+    print(get_all_age_specific_latency_parameters())
+    tb_model = build_tb_model()
     tb_model.run_model()
 
     print(os.getcwd())
     # tb_model.transition_flows.to_csv("_.csv")
 
     # get outputs
-    infectious_population = tb_model.outputs[:, tb_model.compartment_names.index("infectiousXage_0")] + \
-                            tb_model.outputs[:, tb_model.compartment_names.index("infectiousXage_5")] + \
-                            tb_model.outputs[:, tb_model.compartment_names.index("infectiousXage_15")]
-
-    matplotlib.pyplot.plot(times, infectious_population * 1e5)
+    infectious_indices = [tb_model.compartment_indices["infectiousXage_%s" % age] for age in (0, 5, 15)]
+    infectious_population = tb_model.outputs[:, infectious_indices].sum(axis=1)
     # print(infectious_population * 1e5)
 
     # tb_model.death_flows.to_csv("tb_model_deaths.csv")
 
-    matplotlib.pyplot.xlim((1950., 2010.))
-    matplotlib.pyplot.ylim((0.0, 2000.0))
-    # matplotlib.pyplot.show()
+    if arguments.output:
+        numpy.savez_compressed(arguments.output, times=tb_model.times, infectious_population=infectious_population)
+    if arguments.plot:
+        import matplotlib.pyplot
+        matplotlib.pyplot.plot(tb_model.times, infectious_population * 1e5)
+        matplotlib.pyplot.xlim((1950., 2010.))
+        matplotlib.pyplot.ylim((0.0, 2000.0))
+        matplotlib.pyplot.show()